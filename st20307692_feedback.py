@@ -3,7 +3,8 @@ import json
 import os
 import datetime
 import random
-from naoqi import ALProxy
+import threading
+from naoqi import ALProxy, ALBroker, ALModule
 
 # Global variables
 motion = None
@@ -12,6 +13,7 @@ tts = None
 asr = None
 memory = None
 animated_speech = None
+broker = None
 
 # Global variables for feedback data
 current_feedback = {
@@ -33,10 +35,200 @@ speech_event = "WordRecognized"
 # Directory for saving feedback
 feedback_dir = "patient_feedback"
 
+# Speech recognition vocabularies, built once at import
+_NUMBER_WORDS = ("one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten")
+
+# "0" to "10", shared by the numeric and pain vocabularies
+_DIGIT_STRINGS_0_10 = tuple(str(i) for i in range(11))
+
+_NUMERIC_VOCAB_1_10 = _NUMBER_WORDS + _DIGIT_STRINGS_0_10[1:]
+
+# Recognised number -> value for the default 1-10 range
+_WORD_TO_INT = dict(zip(_NUMBER_WORDS, range(1, 11)))
+_WORD_TO_INT.update(zip(_DIGIT_STRINGS_0_10[1:], range(1, 11)))
+
+_PAIN_VOCAB = _DIGIT_STRINGS_0_10 + ("no pain", "mild", "moderate", "severe", "worst pain")
+
+# Basic vocabulary for feedback responses, plus numbers for ratings
+_DEFAULT_LISTEN_VOCAB = (
+    "yes", "no", "maybe", "In detail",
+    "good", "bad", "okay", "excellent", "poor", "fine",
+    "helpful", "not helpful", "somewhat helpful",
+    "better", "worse", "same", "much better", "slightly better",
+    "comfortable", "uncomfortable", "painful", "painless",
+    "professional", "friendly", "knowledgeable", "thorough",
+    "satisfied", "dissatisfied", "neutral",
+    "recommend", "would not recommend",
+    "continue", "stop", "modify",
+    "exercises", "massage", "stretching", "mobilization",
+) + _NUMERIC_VOCAB_1_10
+
+# Pain description -> rating, "no pain"/"none" and "worst" checked before the milder words
+_PAIN_KEYWORDS = (
+    ("no pain", 0),
+    ("none", 0),
+    ("worst", 10),
+    ("severe", 8),
+    ("moderate", 5),
+    ("mild", 2),
+)
+
+# Welcome gesture - slight bow and open arms
+_WELCOME_JOINTS = ["HeadPitch", "RShoulderPitch", "LShoulderPitch", "RShoulderRoll", "LShoulderRoll"]
+_WELCOME_ANGLES = [0.3, 0.7, 0.7, -0.3, 0.3]
+
+# Wave goodbye - raise the right arm, then flap the elbow twice (0.4s per stroke)
+_WAVE_JOINTS = ["RShoulderPitch", "RShoulderRoll", "RWristYaw", "RHand"]
+_WAVE_ANGLES = [0.5, -0.3, 0.0, 0.8]
+_WAVE_ELBOW_ANGLES = [0.8, 1.0] * 2
+_WAVE_ELBOW_TIMES = [0.4 * (i + 1) for i in range(len(_WAVE_ELBOW_ANGLES))]
+
+# Random source for simulated ratings when no answer is recognized
+_rng = random.Random()
+
+# Simulated responses used when ASR gets nothing (development and testing)
+_SIM_RESPONSES = {
+    "session_date": "Today's session was good",
+    "therapist_name": "John Smith",
+    "treatment_helpful": "Yes, the treatment was very helpful",
+    "pain_before": "My pain was about 7 out of 10 before treatment",
+    "pain_after": "Now my pain is about 3 out of 10",
+    "therapist_knowledge": "The therapist was very knowledgeable",
+    "therapist_communication": "Communication was clear and helpful",
+    "exercises": "The exercises were explained well",
+    "facility": "The facility was clean and comfortable",
+    "waiting_time": "I didn't have to wait long",
+    "overall": "Overall I'm very satisfied with the treatment",
+    "continue": "Yes, I want to continue with this treatment plan",
+    "recommend": "I would definitely recommend this to others",
+    "improvements": "Maybe add more appointment time slots"
+}
+
+# Question context -> simulated response key, checked in order
+_CONTEXT_MAP = (
+    ("session date", "session_date"),
+    ("therapist name", "therapist_name"),
+    ("helpful", "treatment_helpful"),
+    ("pain before", "pain_before"),
+    ("pain after", "pain_after"),
+    ("knowledge", "therapist_knowledge"),
+    ("communication", "therapist_communication"),
+    ("exercises", "exercises"),
+    ("facility", "facility"),
+    ("waiting", "waiting_time"),
+    ("overall", "overall"),
+    ("continue", "continue"),
+    ("recommend", "recommend"),
+    ("improvements", "improvements"),
+)
+
+# Satisfaction phrase -> level, most specific phrases first so "very satisfied" wins over "satisfied"
+_SATISFACTION_ORDER = (
+    ("very dissatisfied", "very_dissatisfied"),
+    ("very unhappy", "very_dissatisfied"),
+    ("very satisfied", "very_satisfied"),
+    ("very happy", "very_satisfied"),
+    ("dissatisfied", "dissatisfied"),
+    ("unhappy", "dissatisfied"),
+    ("neutral", "neutral"),
+    ("okay", "neutral"),
+    ("satisfied", "satisfied"),
+    ("happy", "satisfied"),
+)
+
+# Set by the WordRecognized callback when a word has been recognized
+_ready = threading.Event()
+_recognized_word = None  # (turn id, word)
+
+# Each listen() call is a new turn; recognitions outside the active turn are ignored
+_turn_id = 0
+_active_turn = None
+
+# Voice activity for the active turn: the turn ends once a word has been recognized
+# and the patient has been silent for _SILENCE_GUARD seconds
+_have_candidate = False
+_speech_active = False
+_silence_timer = None
+_SILENCE_GUARD = 0.3
+
+# ASR state kept across listen() calls
+_last_vocab_hash = None
+_subscribed = False
+
+# Background thread writing the final feedback export (see conclude_feedback)
+_save_thread = None
+
+# Append-only journal of answers for the current session (created on the first answer)
+_journal_path = None
+
+# FeedbackListener instance; must be a global named like the module for NAOqi to call it
+FeedbackSpeechListener = None
+
+
+class FeedbackListener(ALModule):
+    """
+    Receives NAO's WordRecognized and SpeechDetected events and wakes listen() once the patient is done
+    Callbacks must keep a docstring, or NAOqi won't bind them
+    """
+
+    def onWordRecognized(self, key, value, message):
+        """WordRecognized callback: keep a confident word for the current listen() turn"""
+        global _recognized_word, _have_candidate
+
+        turn = _active_turn
+        word = _confident_word(value)
+        if turn is not None and word:
+            _recognized_word = (turn, word)
+            _have_candidate = True
+            if not _speech_active:
+                _finish_turn_after_silence(turn)
+
+    def onSpeechDetected(self, key, value, message):
+        """Called by NAOqi when the patient starts or stops speaking"""
+        global _speech_active
+
+        _speech_active = bool(value)
+        turn = _active_turn
+        if _speech_active:
+            _cancel_silence_timer()
+        elif turn is not None and _have_candidate:
+            _finish_turn_after_silence(turn)
+
+
+def _cancel_silence_timer():
+    """Cancel a pending end-of-turn timer, if any"""
+    global _silence_timer
+
+    if _silence_timer is not None:
+        _silence_timer.cancel()
+        _silence_timer = None
+
+
+def _finish_turn_after_silence(turn):
+    """Wake listen() after _SILENCE_GUARD seconds of silence, unless the patient speaks again"""
+    global _silence_timer
+
+    def finish():
+        if _active_turn == turn:
+            _ready.set()
+
+    _cancel_silence_timer()
+    _silence_timer = threading.Timer(_SILENCE_GUARD, finish)
+    _silence_timer.daemon = True
+    _silence_timer.start()
+
+
+def _confident_word(value):
+    """Return the word from a WordRecognized value if it was recognized confidently enough, else None"""
+    # value is a list where first element is the word, second is confidence
+    if value and len(value) >= 2 and value[1] > 0.4:
+        return value[0]
+    return None
+
 
 def initialize_nao(robot_ip, robot_port=9559):
     """Initialize connections to NAO's modules"""
-    global motion, posture, tts, asr, memory, animated_speech
+    global motion, posture, tts, asr, memory, animated_speech, broker, FeedbackSpeechListener
 
     # Connect to NAO proxies
     motion = ALProxy("ALMotion", robot_ip, robot_port)
@@ -56,6 +248,12 @@ def initialize_nao(robot_ip, robot_port=9559):
 
     tts.setParameter("speed", 85)
 
+    # Local broker so ALMemory can deliver WordRecognized and SpeechDetected to FeedbackListener
+    broker = ALBroker("FeedbackBroker", "0.0.0.0", 0, robot_ip, robot_port)
+    FeedbackSpeechListener = FeedbackListener("FeedbackSpeechListener")
+    memory.subscribeToEvent(speech_event, "FeedbackSpeechListener", "onWordRecognized")
+    memory.subscribeToEvent("SpeechDetected", "FeedbackSpeechListener", "onSpeechDetected")
+
     # Prepare the robot
     posture.goToPosture("Stand", 0.8)
 
@@ -63,6 +261,9 @@ def initialize_nao(robot_ip, robot_port=9559):
     if not os.path.exists(feedback_dir):
         os.makedirs(feedback_dir)
 
+    # Save any answers an interrupted earlier session left in its journal
+    recover_unsaved_feedback()
+
     return True
 
 
@@ -79,20 +280,26 @@ def get_numeric_rating(question, min_value=1, max_value=10):
     Get a numeric rating using speech interaction
     Returns a number between min_value and max_value
     """
-    speak(question + " Please respond with a number between " + str(min_value) + " and " + str(max_value) + ".")
-
     # Create vocabulary for numbers
-    number_vocabulary = ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten"]
-    for i in range(min_value, max_value + 1):
-        number_vocabulary.append(str(i))
+    if (min_value, max_value) == (1, 10):
+        number_vocabulary = _NUMERIC_VOCAB_1_10
+    else:
+        if 0 <= min_value and max_value <= 10:
+            digits = _DIGIT_STRINGS_0_10[min_value:max_value + 1]
+        else:
+            digits = tuple(str(i) for i in range(min_value, max_value + 1))
+        number_vocabulary = _NUMBER_WORDS + digits
 
     # Try to get numeric response
-    response = listen(20.0, number_vocabulary)
+    response = ask(question + " Please respond with a number between " + str(min_value) + " and " + str(max_value) + ".",
+                   number_vocabulary, 20.0)
 
-    # If response is a valid number, return it
-    if response and response.isdigit():
-        number = int(response)
-        if min_value <= number <= max_value:
+    # If response is a valid number (spoken or digits), return it
+    if response:
+        number = _WORD_TO_INT.get(response.lower())
+        if number is None and response.isdigit():
+            number = int(response)  # Only reached for numbers outside 1-10
+        if number is not None and min_value <= number <= max_value:
             speak("You rated it " + str(number) + ". Thank you.")
             return number
 
@@ -100,24 +307,24 @@ def get_numeric_rating(question, min_value=1, max_value=10):
     speak("I didn't get a clear number. Let me ask differently.")
 
     # Try multiple choice approach
-    speak("Was your rating low, medium, or high?")
-    range_response = listen(8.0, ["low", "medium", "high", "very low", "very high"])
+    range_response = ask("Was your rating low, medium, or high?", ["low", "medium", "high", "very low", "very high"], 8.0)
 
     # Map verbal response to numeric value
     if range_response:
-        if "very low" in range_response.lower():
+        r = range_response.lower()
+        if "very low" in r:
             return min_value
-        elif "low" in range_response.lower():
+        elif "low" in r:
             return min_value + (max_value - min_value) // 4
-        elif "medium" in range_response.lower():
+        elif "medium" in r:
             return min_value + (max_value - min_value) // 2
-        elif "high" in range_response.lower():
+        elif "high" in r:
             return max_value - (max_value - min_value) // 4
-        elif "very high" in range_response.lower():
+        elif "very high" in r:
             return max_value
 
     # If still no valid response, use a simulated value
-    simulated_value = random.randint(min_value, max_value)
+    simulated_value = _rng.randint(min_value, max_value)
     speak(
         "I'll record a " + str(simulated_value) + " for now. You can correct this with your physiotherapist if needed.")
     return simulated_value
@@ -128,37 +335,23 @@ def get_satisfaction_rating(question):
     Get a satisfaction rating using speech interaction
     Returns a string representing satisfaction level
     """
-    speak(question + " Please respond with very dissatisfied, dissatisfied, neutral, satisfied, or very satisfied.")
-
     satisfaction_vocab = [
         "very dissatisfied", "dissatisfied", "neutral", "satisfied", "very satisfied",
         "very unhappy", "unhappy", "okay", "happy", "very happy"
     ]
 
-    response = listen(10.0, satisfaction_vocab)
+    response = ask(question + " Please respond with very dissatisfied, dissatisfied, neutral, satisfied, or very satisfied.",
+                   satisfaction_vocab, 10.0)
 
     # Process response to standard satisfaction levels
     if response:
-        if "very dissatisfied" in response.lower() or "very unhappy" in response.lower():
-            satisfaction = "very_dissatisfied"
-        elif "dissatisfied" in response.lower() or "unhappy" in response.lower():
-            satisfaction = "dissatisfied"
-        elif "neutral" in response.lower() or "okay" in response.lower():
-            satisfaction = "neutral"
-        elif "satisfied" in response.lower() or "happy" in response.lower():
-            if "very" in response.lower():
-                satisfaction = "very_satisfied"
-            else:
-                satisfaction = "satisfied"
-        elif "very satisfied" in response.lower() or "very happy" in response.lower():
-            satisfaction = "very_satisfied"
-        else:
-            # Default to neutral if unclear
-            satisfaction = "neutral"
+        r = response.lower()
+        satisfaction = next((level for needle, level in _SATISFACTION_ORDER if needle in r),
+                            "neutral")  # Default to neutral if unclear
     else:
         # Simulate a response if no valid input
         satisfaction_options = ["dissatisfied", "neutral", "satisfied", "very_satisfied"]
-        satisfaction = random.choice(satisfaction_options)
+        satisfaction = _rng.choice(satisfaction_options)
 
     # Confirm the response
     speak("You selected " + satisfaction.replace("_", " ") + ". Thank you for your feedback.")
@@ -170,19 +363,10 @@ def get_pain_rating(question):
     Get a pain rating using speech interaction
     Returns a number between 0 and 10
     """
-    speak(
-        question + " On a scale from 0 to 10, where 0 means no pain and 10 means worst possible pain, how would you rate your pain?")
-
-    # Create vocabulary for pain ratings
-    pain_vocabulary = []
-    for i in range(0, 11):
-        pain_vocabulary.append(str(i))
-
-    # Additional descriptive terms
-    pain_vocabulary.extend(["no pain", "mild", "moderate", "severe", "worst pain"])
-
     # Try to get numeric response
-    response = listen(10.0, pain_vocabulary)
+    response = ask(
+        question + " On a scale from 0 to 10, where 0 means no pain and 10 means worst possible pain, how would you rate your pain?",
+        _PAIN_VOCAB, 10.0)
 
     # Process response
     if response:
@@ -191,36 +375,25 @@ def get_pain_rating(question):
             if 0 <= pain <= 10:
                 speak("You rated your pain as " + str(pain) + ". Thank you.")
                 return pain
-        elif "no pain" in response.lower():
-            return 0
-        elif "mild" in response.lower():
-            return 2
-        elif "moderate" in response.lower():
-            return 5
-        elif "severe" in response.lower():
-            return 8
-        elif "worst" in response.lower():
-            return 10
+        else:
+            r = response.lower()
+            hit = next((value for keyword, value in _PAIN_KEYWORDS if keyword in r), None)
+            if hit is not None:
+                return hit
 
     # If we get here, we didn't get a valid response - try descriptive approach
-    speak("Let me ask differently. Would you describe your pain as none, mild, moderate, severe, or worst possible?")
-    description = listen(8.0, ["none", "no pain", "mild", "moderate", "severe", "worst"])
+    description = ask("Let me ask differently. Would you describe your pain as none, mild, moderate, severe, or worst possible?",
+                      ["none", "no pain", "mild", "moderate", "severe", "worst"], 8.0)
 
     # Map description to numeric value
     if description:
-        if "none" in description.lower() or "no pain" in description.lower():
-            return 0
-        elif "mild" in description.lower():
-            return 2
-        elif "moderate" in description.lower():
-            return 5
-        elif "severe" in description.lower():
-            return 8
-        elif "worst" in description.lower():
-            return 10
+        r = description.lower()
+        hit = next((value for keyword, value in _PAIN_KEYWORDS if keyword in r), None)
+        if hit is not None:
+            return hit
 
     # If still no valid response, use a simulated value
-    simulated_value = random.randint(0, 10)
+    simulated_value = _rng.randint(0, 10)
     speak("I'll record a pain level of " + str(
         simulated_value) + " for now. You can correct this with your physiotherapist if needed.")
     return simulated_value
@@ -232,130 +405,120 @@ def listen(timeout=8.0, vocabulary=None):
     - timeout: seconds to listen for
     - vocabulary: optional list of words to recognize specifically
     """
-    global speech_event
+    global speech_event, _recognized_word, _turn_id, _active_turn, _subscribed, _have_candidate
 
     # If no vocabulary is provided, use a generic feedback vocabulary
     if vocabulary is None:
-        # Basic vocabulary for feedback responses
-        vocabulary = [
-            "yes", "no", "maybe","In detail",
-            "good", "bad", "okay", "excellent", "poor", "fine",
-            "helpful", "not helpful", "somewhat helpful",
-            "better", "worse", "same", "much better", "slightly better",
-            "comfortable", "uncomfortable", "painful", "painless",
-            "professional", "friendly", "knowledgeable", "thorough",
-            "satisfied", "dissatisfied", "neutral",
-            "recommend", "would not recommend",
-            "continue", "stop", "modify",
-            "exercises", "massage", "stretching", "mobilization",
-            "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten"
-        ]
-        # Add numbers for ratings
-        for i in range(1, 11):
-            vocabulary.append(str(i))
-    asr.pause(True)
-    # Set vocabulary for recognition
-    asr.setVocabulary(vocabulary, False)
+        vocabulary = _DEFAULT_LISTEN_VOCAB
 
-    # Start recognition
-    asr.subscribe("PhysiotherapyFeedback")
+    # Set vocabulary for recognition (a no-op if ask() already loaded it)
+    _finish_vocabulary(_load_vocabulary(vocabulary))
+
+    # Start recognition; the subscription is kept until conclude_feedback()
+    if not _subscribed:
+        asr.subscribe("PhysiotherapyFeedback")
+        _subscribed = True
 
-    asr.pause(False)
     # Listen for the specified timeout
     speak("I'm listening...", animated=False)
 
-    # Wait for response
-    start_time = time.time()
+    # Start a new turn, forgetting any word recognized before this question
+    _turn_id += 1
+    turn = _turn_id
+    _cancel_silence_timer()
+    _ready.clear()
+    _recognized_word = None
+    _have_candidate = False
+    memory.insertData(speech_event, [])
+    _active_turn = turn
+
+    # Wait until a word has been recognized and the patient has stopped talking, or the timeout
     response = None
+    if _ready.wait(timeout) and _recognized_word[0] == turn:
+        response = _recognized_word[1]
+    elif _recognized_word is not None and _recognized_word[0] == turn:
+        # A word was recognized but voice activity never stopped (e.g. background noise)
+        response = _recognized_word[1]
+    else:
+        # A word may have landed just as the wait timed out, or the patient may
+        # still be talking; read both keys from ALMemory in one round trip
+        word_value, speech_detected = memory.getListData([speech_event, "SpeechDetected"])
+        response = _confident_word(word_value)
+        if not response and speech_detected and _ready.wait(1.0) and _recognized_word[0] == turn:
+            response = _recognized_word[1]
 
-    while time.time() - start_time < timeout and not response:
-        # Check if we've recognized a word
-        word_recognized = memory.getData(speech_event)
-
-        if word_recognized and len(word_recognized) >= 2 and word_recognized[1] > 0.4:
-            response = word_recognized[0]
-            print("Recognized: " + response)
-            time.sleep(0.5)
-
-        time.sleep(0.2)  # Check every 200ms
+    if response:
+        print("Recognized: " + response)
 
-    # Stop recognition
-    asr.unsubscribe("PhysiotherapyFeedback")
+    # Stop accepting recognitions
+    _active_turn = None
+    _cancel_silence_timer()
 
     if not response:
         # For development and testing, simulate a response
         print("ASR failed to get response, using simulated input")
-        simulated_responses = {
-            "session_date": "Today's session was good",
-            "therapist_name": "John Smith",
-            "treatment_helpful": "Yes, the treatment was very helpful",
-            "pain_before": "My pain was about 7 out of 10 before treatment",
-            "pain_after": "Now my pain is about 3 out of 10",
-            "therapist_knowledge": "The therapist was very knowledgeable",
-            "therapist_communication": "Communication was clear and helpful",
-            "exercises": "The exercises were explained well",
-            "facility": "The facility was clean and comfortable",
-            "waiting_time": "I didn't have to wait long",
-            "overall": "Overall I'm very satisfied with the treatment",
-            "continue": "Yes, I want to continue with this treatment plan",
-            "recommend": "I would definitely recommend this to others",
-            "improvements": "Maybe add more appointment time slots"
-        }
-
         # Map question context to simulated responses
-        response_key = None
-        if "session date" in current_function_context:
-            response_key = "session_date"
-        elif "therapist name" in current_function_context:
-            response_key = "therapist_name"
-        elif "helpful" in current_function_context:
-            response_key = "treatment_helpful"
-        elif "pain before" in current_function_context:
-            response_key = "pain_before"
-        elif "pain after" in current_function_context:
-            response_key = "pain_after"
-        elif "knowledge" in current_function_context:
-            response_key = "therapist_knowledge"
-        elif "communication" in current_function_context:
-            response_key = "therapist_communication"
-        elif "exercises" in current_function_context:
-            response_key = "exercises"
-        elif "facility" in current_function_context:
-            response_key = "facility"
-        elif "waiting" in current_function_context:
-            response_key = "waiting_time"
-        elif "overall" in current_function_context:
-            response_key = "overall"
-        elif "continue" in current_function_context:
-            response_key = "continue"
-        elif "recommend" in current_function_context:
-            response_key = "recommend"
-        elif "improvements" in current_function_context:
-            response_key = "improvements"
-        else:
-            response_key = "overall"  # Default fallback
-
-        response = simulated_responses.get(response_key, "Yes")
+        response_key = next((key for needle, key in _CONTEXT_MAP if needle in current_function_context),
+                            "overall")  # Default fallback
+        response = _SIM_RESPONSES.get(response_key, "Yes")
 
     return response
 
 
+def _load_vocabulary(vocabulary):
+    """
+    Start loading a vocabulary into NAO's ASR if it differs from the last one
+    Returns the setVocabulary task id, or None if nothing needed loading
+    """
+    global _last_vocab_hash
+
+    vocab_hash = hash(tuple(vocabulary))
+    if vocab_hash == _last_vocab_hash:
+        return None
+    _last_vocab_hash = vocab_hash
+
+    asr.pause(True)
+    return asr.post.setVocabulary(list(vocabulary), False)
+
+
+def _finish_vocabulary(task):
+    """Wait for a vocabulary started by _load_vocabulary() and resume recognition"""
+    if task is not None:
+        asr.wait(task, 0)
+        asr.pause(False)
+
+
+def ask(question, vocabulary=None, timeout=8.0, animated=True):
+    """
+    Ask a question and listen for the answer
+    The vocabulary is loaded into the ASR while NAO is still speaking the question
+    """
+    if vocabulary is None:
+        vocabulary = _DEFAULT_LISTEN_VOCAB
+
+    task = _load_vocabulary(vocabulary)
+
+    speak(question, animated)
+
+    _finish_vocabulary(task)
+    return listen(timeout, vocabulary)
+
+
+def stop_listening():
+    """Unsubscribe from NAO's speech recognition at the end of the feedback session"""
+    global _subscribed
+
+    if _subscribed:
+        asr.unsubscribe("PhysiotherapyFeedback")
+        _subscribed = False
+
+
 def greet_patient():
     """Greet the patient after their physiotherapy session"""
     global current_function_context
 
-    # Welcome gesture - slight bow and open arms
-    motion.setAngles("HeadPitch", 0.3, 0.2)  # Slight bow
-    motion.setAngles("RShoulderPitch", 0.7, 0.2)
-    motion.setAngles("LShoulderPitch", 0.7, 0.2)
-    motion.setAngles("RShoulderRoll", -0.3, 0.2)  # Open arms
-    motion.setAngles("LShoulderRoll", 0.3, 0.2)
-
-    time.sleep(1.0)
-
-    # Return to neutral posture
-    motion.setAngles("HeadPitch", 0.0, 0.2)
-    posture.goToPosture("Stand", 0.8)
+    # Welcome gesture - slight bow and open arms, played while NAO speaks
+    gesture = motion.post.angleInterpolationWithSpeed(_WELCOME_JOINTS, _WELCOME_ANGLES, 0.3)
 
     # Greeting speech
     greeting = """
@@ -365,7 +528,12 @@ def greet_patient():
     Would you mind taking a moment to share your feedback with me?
     """
 
-    speak(greeting)
+    # Body language is off so the speech animations don't override the welcome gesture
+    animated_speech.say(greeting, {"bodyLanguageMode": "disabled"})
+
+    # Return to neutral posture
+    motion.wait(gesture, 0)
+    posture.goToPosture("Stand", 0.8)
 
     # Wait for acknowledgment
     current_function_context = "greeting"
@@ -381,102 +549,33 @@ def greet_patient():
         return True
 
 
-def collect_session_info():
-    """Collect basic information about the session"""
-    global current_function_context, current_feedback
-
-    speak("First, let's confirm a few details about today's session.")
-
-    # Get date of session (usually today)
-    current_function_context = "session date"
-    speak("Was your session today, or on a different date?")
-    session_date = listen(15.0, ["today", "yesterday", "different date"])
-
-    if session_date and "today" in session_date.lower():
-        session_date = datetime.datetime.now().strftime("%Y-%m-%d")
-    elif session_date and "yesterday" in session_date.lower():
-        yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
-        session_date = yesterday.strftime("%Y-%m-%d")
-    else:
-        # Default to today if unclear
-        session_date = datetime.datetime.now().strftime("%Y-%m-%d")
-
-    current_feedback["session_info"]["date"] = session_date
-
-    # Get therapist name
-    current_function_context = "therapist name"
-    speak("What is the name of your physiotherapist?")
-    therapist_name = listen(15.0, ["Jack", "Smith"])
-
-    if therapist_name:
-        current_feedback["session_info"]["therapist"] = therapist_name
+def _session_date(answer):
+    """Turn the spoken session date into YYYY-MM-DD, defaulting to today if unclear"""
+    now = datetime.datetime.now()
+    if answer and "yesterday" in answer.lower() and "today" not in answer.lower():
+        now -= datetime.timedelta(days=1)
+    return now.strftime("%Y-%m-%d")
 
-    # Get patient name if not already known
-    current_function_context = "patient name"
-    speak("And your name please?")
-    patient_name = listen(15.0, ["Bon", "Smith"])
 
+def _set_feedback_path(patient_name):
+    """
+    Work out the session's feedback file once, as soon as the patient's name is known,
+    so every save_feedback() call rewrites the same file
+    """
     if patient_name:
-        current_feedback["session_info"]["patient"] = patient_name
-
-    # Get treatment type
-    current_function_context = "treatment type"
-    speak(
-        "What type of treatment did you receive today? For example, was it manual therapy, exercises, or something else?")
-    treatment_type = listen(15.0, ["Excercise"])
+        safe_name = patient_name.lower().replace(" ", "_")
+        date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        current_feedback["_path"] = os.path.join(feedback_dir, safe_name + "_feedback_" + date + ".json")
+    return patient_name
 
-    if treatment_type:
-        current_feedback["session_info"]["treatment_type"] = treatment_type
 
+def _report_pain_change(pain_after):
+    """Record the change in pain since before the treatment and tell the patient about it"""
+    pain_before = current_feedback["pain_assessment"].get("before")
 
-def assess_treatment_effectiveness():
-    """Assess how effective the treatment was"""
-    global current_function_context, current_feedback
-
-    speak("Now, I'd like to ask about the effectiveness of your treatment.")
-
-    # Was treatment helpful
-    current_function_context = "treatment helpful"
-    speak("Did you find today's treatment helpful?")
-    helpful = listen(10.0, ["yes", "no", "somewhat", "very", "not really"])
-
-    if helpful:
-        current_feedback["treatment_feedback"]["helpful"] = helpful
-
-    # Numeric rating for treatment effectiveness
-    effectiveness = get_numeric_rating(
-        "On a scale from 1 to 10, how would you rate the effectiveness of today's treatment?")
-    current_feedback["treatment_feedback"]["effectiveness_rating"] = effectiveness
-
-    # Free form feedback
-    current_function_context = "treatment feedback"
-    speak("Is there anything specific about the treatment that worked well or could be improved?")
-    treatment_feedback = listen(20.0)
-
-    if treatment_feedback:
-        current_feedback["treatment_feedback"]["comments"] = treatment_feedback
-
-
-def assess_pain_levels():
-    """Assess pain levels before and after treatment"""
-    global current_function_context, current_feedback
-
-    speak("Next, let's talk about your pain levels.")
-
-    # Pain before treatment
-    current_function_context = "pain before"
-    pain_before = get_pain_rating("How would you rate your pain before today's treatment?")
-    current_feedback["pain_assessment"]["before"] = pain_before
-
-    # Pain after treatment
-    current_function_context = "pain after"
-    pain_after = get_pain_rating("And how would you rate your pain now, after the treatment?")
-    current_feedback["pain_assessment"]["after"] = pain_after
-
-    # Calculate pain reduction and provide feedback
     if isinstance(pain_before, (int, float)) and isinstance(pain_after, (int, float)):
         pain_reduction = pain_before - pain_after
-        current_feedback["pain_assessment"]["change"] = pain_reduction
+        _record("pain_assessment", "change", pain_reduction)
 
         if pain_reduction > 0:
             speak("That's great! Your pain has decreased by " + str(pain_reduction) + " points.")
@@ -485,54 +584,194 @@ def assess_pain_levels():
         else:
             speak("I notice your pain has increased. This is important information for your therapist to know.")
 
-    # Location of remaining pain
-    current_function_context = "pain location"
-    speak("Could you tell me where you're still experiencing pain, if any?")
-    pain_location = listen(15.0)
+    return pain_after
+
+
+# The feedback interview, asked in order by run_interview()
+# Each phase is (introduction, questions) and each question is
+# (context, section, key, rating, prompt, vocabulary, timeout, post_process):
+# - context: current_function_context while the question is asked
+# - rating: get_*_rating function for rated answers, or None to ask() for a free answer
+#   (free answers are only stored if something was heard)
+# - vocabulary/timeout: passed to ask() for free answers (vocabulary None = default)
+# - post_process: optional function applied to the answer before it is stored
+_INTERVIEW = (
+    ("First, let's confirm a few details about today's session.", (
+        ("session date", "session_info", "date", None,
+         "Was your session today, or on a different date?",
+         ["today", "yesterday", "different date"], 15.0, _session_date),
+        ("therapist name", "session_info", "therapist", None,
+         "What is the name of your physiotherapist?",
+         ["Jack", "Smith"], 15.0, None),
+        ("patient name", "session_info", "patient", None,
+         "And your name please?",
+         ["Bon", "Smith"], 15.0, _set_feedback_path),
+        ("treatment type", "session_info", "treatment_type", None,
+         "What type of treatment did you receive today? For example, was it manual therapy, exercises, or something else?",
+         ["Excercise"], 15.0, None),
+    )),
+    ("Now, I'd like to ask about the effectiveness of your treatment.", (
+        ("treatment helpful", "treatment_feedback", "helpful", None,
+         "Did you find today's treatment helpful?",
+         ["yes", "no", "somewhat", "very", "not really"], 10.0, None),
+        ("treatment effectiveness", "treatment_feedback", "effectiveness_rating", get_numeric_rating,
+         "On a scale from 1 to 10, how would you rate the effectiveness of today's treatment?",
+         None, None, None),
+        ("treatment feedback", "treatment_feedback", "comments", None,
+         "Is there anything specific about the treatment that worked well or could be improved?",
+         None, 20.0, None),
+    )),
+    ("Next, let's talk about your pain levels.", (
+        ("pain before", "pain_assessment", "before", get_pain_rating,
+         "How would you rate your pain before today's treatment?",
+         None, None, None),
+        ("pain after", "pain_assessment", "after", get_pain_rating,
+         "And how would you rate your pain now, after the treatment?",
+         None, None, _report_pain_change),
+        ("pain location", "pain_assessment", "location", None,
+         "Could you tell me where you're still experiencing pain, if any?",
+         None, 15.0, None),
+    )),
+    ("Finally, let's talk about your overall experience and future plans.", (
+        ("overall", "overall_experience", "satisfaction", get_satisfaction_rating,
+         "Overall, how satisfied are you with your physiotherapy experience today?",
+         None, None, None),
+        ("continue", "overall_experience", "continue_treatment", None,
+         "Do you feel you would benefit from continuing with your current treatment plan?",
+         ["yes", "no", "not sure", "maybe"], 10.0, None),
+        ("recommend", "overall_experience", "would_recommend", None,
+         "Would you recommend our physiotherapy services to friends or family?",
+         ["yes", "no", "maybe", "definitely", "probably not"], 10.0, None),
+        ("improvements", "overall_experience", "improvement_suggestions", None,
+         "Do you have any suggestions for how we could improve our services?",
+         None, 20.0, None),
+    )),
+)
+
+
+def run_interview():
+    """Ask every question in _INTERVIEW, recording each answer as soon as it is given"""
+    global current_function_context
+
+    for introduction, questions in _INTERVIEW:
+        speak(introduction)
+
+        for context, section, key, rating, prompt, vocabulary, timeout, post_process in questions:
+            current_function_context = context
+
+            if rating is not None:
+                answer = rating(prompt)
+            else:
+                answer = ask(prompt, vocabulary, timeout)
+
+            if post_process is not None:
+                answer = post_process(answer)
+
+            if rating is not None or answer:
+                _record(section, key, answer)
+
+        time.sleep(1)
+
 
-    if pain_location:
-        current_feedback["pain_assessment"]["location"] = pain_location
+def _append_kv(section, key, value):
+    """Append one answer to the session journal and fsync it, so it survives a crash"""
+    global _journal_path
 
+    if _journal_path is None:
+        started = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        _journal_path = os.path.join(feedback_dir, "session_" + started + ".jsonl")
 
-def overall_experience():
-    """Assess overall experience and future intentions"""
-    global current_function_context, current_feedback
+    try:
+        with open(_journal_path, 'a', 1) as f:
+            f.write(json.dumps({"s": section, "k": key, "v": value}, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception as e:
+        print("Error writing feedback journal: " + str(e))
 
-    speak("Finally, let's talk about your overall experience and future plans.")
 
-    # Overall satisfaction
-    current_function_context = "overall"
-    overall = get_satisfaction_rating("Overall, how satisfied are you with your physiotherapy experience today?")
-    current_feedback["overall_experience"]["satisfaction"] = overall
+def _record(section, key, value):
+    """
+    Store an answer in current_feedback and append it to the session journal
+    - section: current_feedback section, or None for a top-level key
+    """
+    if section is None:
+        current_feedback[key] = value
+    else:
+        current_feedback[section][key] = value
+    _append_kv(section, key, value)
+
+
+def recover_feedback(journal_path):
+    """Rebuild a feedback dict from a session journal, e.g. after the robot crashed mid-interview"""
+    feedback = {
+        "session_info": {},
+        "treatment_feedback": {},
+        "pain_assessment": {},
+        "therapist_feedback": {},
+        "facility_feedback": {},
+        "overall_experience": {},
+        "timestamp": ""
+    }
+
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Last line may be partial if the crash hit mid-write
+            if entry["s"] is None:
+                feedback[entry["k"]] = entry["v"]
+            else:
+                feedback.setdefault(entry["s"], {})[entry["k"]] = entry["v"]
 
-    # Continue treatment
-    current_function_context = "continue"
-    speak("Do you feel you would benefit from continuing with your current treatment plan?")
-    continue_treatment = listen(10.0, ["yes", "no", "not sure", "maybe"])
+    return feedback
 
-    if continue_treatment:
-        current_feedback["overall_experience"]["continue_treatment"] = continue_treatment
 
-    # Would recommend
-    current_function_context = "recommend"
-    speak("Would you recommend our physiotherapy services to friends or family?")
-    recommend = listen(10.0, ["yes", "no", "maybe", "definitely", "probably not"])
+def recover_unsaved_feedback():
+    """Turn session journals left behind by an interrupted session into feedback files"""
+    for name in sorted(os.listdir(feedback_dir)):
+        if not (name.startswith("session_") and name.endswith(".jsonl")):
+            continue
 
-    if recommend:
-        current_feedback["overall_experience"]["would_recommend"] = recommend
+        journal_path = os.path.join(feedback_dir, name)
+        try:
+            feedback = recover_feedback(journal_path)
+            patient_name = feedback["session_info"].get("patient") or "unknown"
+            safe_name = patient_name.lower().replace(" ", "_")
+            started = name[len("session_"):-len(".jsonl")]
+            filename = os.path.join(feedback_dir, safe_name + "_feedback_" + started + "_recovered.json")
+            _write_json(filename, feedback, pretty=True)
+            os.remove(journal_path)
+            print("Recovered unsaved feedback from " + journal_path + " into " + filename)
+        except Exception as e:
+            print("Error recovering feedback journal " + journal_path + ": " + str(e))
 
-    # Suggestions for improvement
-    current_function_context = "improvements"
-    speak("Do you have any suggestions for how we could improve our services?")
-    improvements = listen(20.0)
 
-    if improvements:
-        current_feedback["overall_experience"]["improvement_suggestions"] = improvements
+def _write_json(filename, data, pretty=False):
+    """
+    Write data as JSON to a temporary file, then rename it into place so a
+    power loss mid-write never leaves a half-written file
+    """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        if pretty:
+            json.dump(data, f, indent=4)
+        else:
+            json.dump(data, f, separators=(",", ":"))
+    # os.rename can't replace an existing file on Windows (Python 2 has no os.replace)
+    if os.name == "nt" and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
 
 
-def save_feedback():
-    """Save the feedback data to a JSON file"""
-    global current_feedback, feedback_dir
+def save_feedback(pretty=False):
+    """
+    Save the feedback data to a JSON file
+    - pretty: indent the JSON (used for the final export; in-session saves are compact)
+    The session journal is removed once the final export is in place
+    """
+    global current_feedback, feedback_dir, _journal_path
 
     # Check if we have enough data to save
     if not current_feedback["session_info"].get("patient"):
@@ -542,25 +781,34 @@ def save_feedback():
     # Add timestamp
     current_feedback["timestamp"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    # Create a filename based on patient name and date
-    patient_name = current_feedback["session_info"]["patient"]
-    safe_name = patient_name.lower().replace(" ", "_")
-    date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = os.path.join(feedback_dir, safe_name + "_feedback_" + date + ".json")
+    # One file per session, based on patient name and date
+    if "_path" not in current_feedback:
+        _set_feedback_path(current_feedback["session_info"]["patient"])
+    filename = current_feedback["_path"]
+
+    # Leave out internal helper keys (those starting with "_")
+    feedback = {k: v for k, v in current_feedback.items() if not k.startswith("_")}
 
     # Save the feedback
     try:
-        with open(filename, 'w') as f:
-            json.dump(current_feedback, f, indent=4)
-        return True
+        _write_json(filename, feedback, pretty)
     except Exception as e:
         print("Error saving feedback: " + str(e))
         return False
 
+    # Everything in the journal is now in the final file
+    if pretty and _journal_path is not None:
+        try:
+            os.remove(_journal_path)
+            _journal_path = None
+        except OSError as e:
+            print("Error removing feedback journal: " + str(e))
+    return True
+
 
 def conclude_feedback():
     """Thank the patient and conclude the feedback session"""
-    global current_function_context, current_feedback
+    global current_function_context, current_feedback, _save_thread
 
     # Thank you gesture
     motion.setAngles("HeadPitch", 0.1, 0.2)  # Slight bow
@@ -573,35 +821,33 @@ def conclude_feedback():
     Is there anything else you'd like to share before we finish?
     """
 
-    speak(conclusion)
-
     # Final comments
     current_function_context = "final comments"
-    final_comments = listen(15.0)
+    final_comments = ask(conclusion, None, 15.0)
 
     if final_comments:
-        current_feedback["final_comments"] = final_comments
-        save_feedback()  # Update saved feedback with final comments
+        _record(None, "final_comments", final_comments)
 
-    # Final goodbye
-    speak(
-        "Thank you again for your feedback. We look forward to seeing you at your next appointment. Have a wonderful day!")
+    # Export the final feedback over the in-session file while NAO says goodbye
+    _save_thread = threading.Thread(target=save_feedback, kwargs={"pretty": True})
+    _save_thread.daemon = True
+    _save_thread.start()
 
-    # Wave goodbye
-    motion.setAngles("RShoulderPitch", 0.5, 0.2)
-    motion.setAngles("RShoulderRoll", -0.3, 0.2)
-    motion.setAngles("RWristYaw", 0.0, 0.2)
-    motion.setAngles("RHand", 0.8, 0.2)
+    # Wave goodbye during the final goodbye
+    motion.setAngles(_WAVE_JOINTS, _WAVE_ANGLES, 0.2)
+    wave = motion.post.angleInterpolation("RElbowRoll", _WAVE_ELBOW_ANGLES, _WAVE_ELBOW_TIMES, True)
 
-    for _ in range(2):
-        motion.setAngles("RElbowRoll", 0.8, 0.2)
-        time.sleep(0.4)
-        motion.setAngles("RElbowRoll", 1.0, 0.2)
-        time.sleep(0.4)
+    # Body language is off so it doesn't fight the wave
+    animated_speech.say(
+        "Thank you again for your feedback. We look forward to seeing you at your next appointment. Have a wonderful day!",
+        {"bodyLanguageMode": "disabled"})
 
     # Reset to a neutral posture
+    motion.wait(wave, 0)
     posture.goToPosture("Stand", 0.8)
 
+    stop_listening()
+
 
 def run_feedback_collection(robot_ip, robot_port=9559):
     """Run the complete feedback collection workflow"""
@@ -619,17 +865,7 @@ def run_feedback_collection(robot_ip, robot_port=9559):
         time.sleep(1)
 
         # Collect feedback
-        collect_session_info()
-        time.sleep(1)
-
-        assess_treatment_effectiveness()
-        time.sleep(1)
-
-        assess_pain_levels()
-        time.sleep(1)
-
-        overall_experience()
-        time.sleep(1)
+        run_interview()
 
         # Save feedback data
         saved = save_feedback()
@@ -637,11 +873,22 @@ def run_feedback_collection(robot_ip, robot_port=9559):
         # Conclude
         conclude_feedback()
 
+        # Let the final export finish before returning
+        if _save_thread is not None:
+            _save_thread.join(2.0)
+
         return True
     except Exception as e:
         print("Error during feedback collection: " + str(e))
         speak("I'm experiencing a technical issue. Let me notify the staff.")
         return False
+    finally:
+        # Stop receiving speech events
+        if broker:
+            stop_listening()
+            memory.unsubscribeToEvent(speech_event, "FeedbackSpeechListener")
+            memory.unsubscribeToEvent("SpeechDetected", "FeedbackSpeechListener")
+            broker.shutdown()
 
 
 if __name__ == "__main__":
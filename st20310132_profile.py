@@ -1,37 +1,164 @@
+import atexit
 import time
 import json
 import os
+import re
 import datetime
+import threading
 import requests
-from naoqi import ALProxy
+from requests.adapters import HTTPAdapter
+from naoqi import ALProxy, ALBroker, ALModule
+
+# Runs of punctuation and spaces, replaced by "_" when turning a question into a dict key
+_KEY_RE = re.compile(r"[^\w]+")
+
+# Answers stored as they are, without an LLM interpretation
+_TRIVIAL_RESPONSES = frozenset(["yes", "no", "maybe", "okay", "fine", "none", "never"])
+
+# How long Ollama keeps the model loaded after a request
+_OLLAMA_KEEP_ALIVE = "30m"
+
+# Ollama request timeouts, in seconds: connecting should be quick, but reading the reply includes
+# evaluating the prompt and decoding every requested token, which is slow on a CPU-hosted model
+_OLLAMA_CONNECT_TIMEOUT = 3
+_OLLAMA_READ_TIMEOUT_BASE = 60
+_OLLAMA_READ_TIMEOUT_PER_TOKEN = 0.5
+# The first request also loads the model into memory
+_OLLAMA_LOAD_TIMEOUT = 300
+
+
+def _is_trivial_response(response):
+    """Check whether a patient response is too short to be worth interpreting with the LLM"""
+    return response.lower().strip() in _TRIVIAL_RESPONSES or len(response.split()) < 2
+
+
+class SpeechListener(ALModule):
+    """Collects words from ALMemory's WordRecognized event and wakes the waiting listener"""
+
+    def __init__(self, name):
+        ALModule.__init__(self, name)
+        self.word_event = threading.Event()
+        self._words = []
+        self._lock = threading.Lock()
+
+    def onWordRecognized(self, key, value, message):
+        """Called by NAOqi when a word is recognized (NAOqi only binds methods with docstrings)"""
+        # value is a list where first element is the word, second is confidence
+        if value and len(value) >= 2 and value[1] > 0.4:
+            with self._lock:
+                self._words.append(value[0])
+                self.word_event.set()
+
+    def take_words(self):
+        """Return the words recognized since the last call and reset the event"""
+        with self._lock:
+            words = self._words
+            self._words = []
+            self.word_event.clear()
+        return words
+
+
+# NAOqi looks up Python modules by their global name, so the listener instance lives here
+PhysioSpeechListener = None
 
 
 class PhysiotherapyAssistant(object):
-    def __init__(self, robot_ip, robot_port=9559, ollama_url="http://localhost:11434"):
-        """Initialize the NAO physiotherapy assistant"""
-        # NAO proxies
+    # Basic vocabulary for general responses, plus numbers for age, pain scale, etc.
+    DEFAULT_VOCABULARY = tuple([
+        "yes", "no", "maybe","father","Bob","Walking", "Lifting", "Running", "Legs", "Knee", "Jack", "Knee and Shoulder", "Shoulder",
+        "good", "bad", "okay", "fine",
+        "pain", "hurt", "sore", "ache",
+        "left", "right", "arm", "leg", "back", "neck", "shoulder", "knee", "hip",
+        "daily", "weekly", "sometimes", "always", "never",
+        "mild", "moderate", "severe", "extreme",
+        "walk", "sit", "stand", "lift", "climb", "bend",
+        "medication", "surgery", "injury", "accident",
+        "doctor", "hospital", "therapy", "treatment",
+        "better", "worse", "same", "improving", "worsening",
+        "exercise", "stretch", "mobility", "strength",
+        "morning", "afternoon", "evening", "night",
+        "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten","forty"
+    ] + [str(i) for i in range(1, 100)])
+
+    # Fallback vocabulary when the patient's answer was not recognized
+    YES_NO_VOCABULARY = ("yes", "no")
+
+    # Standard physiotherapy assessment questions
+    ASSESSMENT_QUESTIONS = (
+        "Can you describe where you're experiencing pain or discomfort?",
+        "On a scale of 0-10, how would you rate your pain, with 10 being the most severe?",
+        "What movements or activities make your symptoms worse?",
+        "What daily activities are difficult for you because of this issue?",
+        "Have you had physiotherapy for this condition before? If so, what worked or didn't work?"
+    )
+
+    # Simulated responses for development and testing, keyed by question context
+    SIMULATED_RESPONSES = {
+        "name": "John Smith",
+        "age": "45",
+        "phone": "555-123-4567",
+        "emergency": "Mary Smith, wife, 555-987-6543",
+        "conditions": "Lower back pain for 3 months, mild hypertension",
+        "medications": "Ibuprofen occasionally, blood pressure medication daily",
+        "surgeries": "No previous surgeries",
+        "allergies": "No known allergies",
+        "pain": "Lower back, worse on the right side",
+        "pain_scale": "6 out of 10 when standing for long periods",
+        "worse": "Sitting for long periods and bending forward",
+        "activities": "Difficulty gardening and carrying groceries",
+        "previous": "No previous physiotherapy",
+        "goals": "I want to be able to garden again without pain and return to my walking routine"
+    }
+
+    def __init__(self, robot_ip, robot_port=9559, ollama_url="http://localhost:11434",
+                 ollama_model="mistral:7b-instruct-q4_K_M", dynamic_questions=False):
+        """
+        Initialize the NAO physiotherapy assistant
+        - ollama_model: Ollama model tag to use for all LLM calls
+        - dynamic_questions: have the LLM generate the assessment questions instead of using the standard ones
+        """
+        # NAO proxies, connected in parallel
         self.robot_ip = robot_ip
         self.robot_port = robot_port
-        self.motion = ALProxy("ALMotion", robot_ip, robot_port)
-        self.posture = ALProxy("ALRobotPosture", robot_ip, robot_port)
-        self.tts = ALProxy("ALTextToSpeech", robot_ip, robot_port)
-        self.asr = ALProxy("ALSpeechRecognition", robot_ip, robot_port)
-        self.memory = ALProxy("ALMemory", robot_ip, robot_port)
-        self.animated_speech = ALProxy("ALAnimatedSpeech", robot_ip, robot_port)
+        proxies = self._connect_proxies(["ALMotion", "ALRobotPosture", "ALTextToSpeech",
+                                         "ALSpeechRecognition", "ALMemory", "ALAnimatedSpeech", "ALLeds"])
+        self.motion = proxies["ALMotion"]
+        self.posture = proxies["ALRobotPosture"]
+        self.tts = proxies["ALTextToSpeech"]
+        self.asr = proxies["ALSpeechRecognition"]
+        self.memory = proxies["ALMemory"]
+        self.animated_speech = proxies["ALAnimatedSpeech"]
+        self.leds = proxies["ALLeds"]
+
+        # Prepare the robot in the background while the rest of the setup runs
+        posture_task = self.posture.post.goToPosture("Stand", 0.8)
 
         # Configure speech recognition (NAO's built-in ASR)
+        # It stays paused except while _listen is waiting for an answer
 
         self.asr.pause(True)
         self.asr.setLanguage("English")
         # Increase word spotting sensitivity
         self.asr.setParameter("Sensitivity", 0.5)
-        self.asr.pause(False)
         # Set NAO's voice speed
         self.tts.setParameter("speed", 85)
 
         # Initialize Ollama LLM API details
         self.ollama_url = ollama_url
-        self.ollama_model = "mistral"  # Using Mistral Model
+        # Using Mistral Model, 4-bit quantized by default: about a quarter of the memory of FP16 and
+        # noticeably faster per token, with little accuracy loss for short summaries like ours
+        self.ollama_model = ollama_model
+        # Fixed context size so Ollama doesn't rebuild the KV cache between calls; sized for the largest call,
+        # the combined interpretation and summary (patient JSON + items ~1200 tokens in, up to ~800 out)
+        self.ollama_num_ctx = 4096
+
+        # Reuse one pooled keep-alive connection for all Ollama calls
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self.session.headers.update({"Content-Type": "application/json", "Connection": "keep-alive"})
+
+        # Ask the standard assessment questions unless dynamic generation is requested
+        self.dynamic_questions = dynamic_questions
 
         # Patient data storage
         self.patients_dir = "patient_profiles"
@@ -45,37 +172,135 @@ class PhysiotherapyAssistant(object):
             "physiotherapy_assessment": {},
             "session_notes": []
         }
+        self._profile_path = None  # File the current patient's profile is saved to
+        self._patient_json_cache = None  # Serialized current_patient, cleared on every update
 
         # Speech subscriber setup
         self.speech_event = "WordRecognized"
+        self._last_vocabulary = None  # Vocabulary currently loaded into the ASR
+
+        # Receive recognized words as ALMemory events instead of polling for them
+        global PhysioSpeechListener
+        self.broker = ALBroker("PhysiotherapyBroker", "0.0.0.0", 0, robot_ip, robot_port)
+        PhysioSpeechListener = SpeechListener("PhysioSpeechListener")
+        self.speech_listener = PhysioSpeechListener
+        self.memory.subscribeToEvent(self.speech_event, "PhysioSpeechListener", "onWordRecognized")
+
+        # Subscribe to the ASR once for the whole session
+        self.asr.subscribe("PhysiotherapyAssistant")
+        self._closed = False
+        atexit.register(self.close)
 
         # Current function context (for simulated responses)
         self.current_function_context = ""
 
-        # Test Ollama connection
+        # Test Ollama connection and load the model in the background, overlapping the greeting
+        self.ollama_available = None  # Unknown until the connection test finishes
+        warm_up = threading.Thread(target=self._warm_up_ollama)
+        warm_up.daemon = True
+        warm_up.start()
+
+        # Make sure the robot is standing before the session starts
+        self.posture.wait(posture_task, 0)
+
+    def _connect_proxies(self, module_names):
+        """Create NAOqi proxies concurrently, returned by module name"""
+        proxies = {}
+        errors = []
+
+        def connect(module_name):
+            try:
+                proxies[module_name] = ALProxy(module_name, self.robot_ip, self.robot_port)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=connect, args=(name,)) for name in module_names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return proxies
+
+    def _test_ollama_connection(self):
+        """
+        Test connection to Ollama LLM
+        Raises requests.ConnectionError if Ollama cannot be reached, or another exception for any other problem
+        """
+        test_prompt = "Respond with 'OK' if you can read this message."
+        payload = {
+            "model": self.ollama_model,
+            "messages": self._build_messages(test_prompt),
+            "stream": False,
+            "keep_alive": _OLLAMA_KEEP_ALIVE,
+            # Only a few tokens are needed; the request also loads the model into memory
+            "options": {"num_predict": 4, "num_ctx": self.ollama_num_ctx}
+        }
+        response = self.session.post(self.ollama_url + "/api/chat", json=payload,
+                                     timeout=(_OLLAMA_CONNECT_TIMEOUT, _OLLAMA_LOAD_TIMEOUT))
+        response.raise_for_status()
+
+    def _warm_up_ollama(self):
+        """
+        Test the Ollama connection once, loading the model in the process
+        Only a failed connection marks Ollama as unavailable; any other problem leaves it to the next call
+        """
         try:
             self._test_ollama_connection()
-            print("Successfully connected to Ollama LLM at " + ollama_url)
-        except Exception as e:
+            self.ollama_available = True
+            print("Successfully connected to Ollama LLM at " + self.ollama_url)
+        except requests.ConnectionError as e:
+            self.ollama_available = False
             print("Warning: Could not connect to Ollama LLM: " + str(e))
-            print("Make sure Ollama is running at " + ollama_url + " or speech interactions will be limited")
+            print("Make sure Ollama is running at " + self.ollama_url + " or speech interactions will be limited")
+        except Exception as e:
+            print("Warning: Ollama LLM warm-up failed: " + str(e))
 
-        # Prepare the robot
-        self.posture.goToPosture("Stand", 0.8)
+    def _speak(self, text, animated=True, wait=True):
+        """
+        Make NAO speak with optional animation
+        - wait: block until NAO has finished speaking
+        Returns the NAOqi task id of the speech when wait is False, for waiting on later
+        """
+        proxy = self.animated_speech if animated else self.tts
+        if wait:
+            proxy.say(text)
+            return None
+        return proxy.post.say(text)
 
-    def _test_ollama_connection(self):
-        """Test connection to Ollama LLM"""
-        test_prompt = "Respond with 'OK' if you can read this message."
-        response = self._llm_interact(test_prompt)
-        if "OK" not in response:
-            raise Exception("Ollama response did not contain expected confirmation")
-
-    def _speak(self, text, animated=True):
-        """Make NAO speak with optional animation"""
-        if animated:
-            self.animated_speech.say(text)
-        else:
-            self.tts.say(text)
+    def _set_vocabulary(self, vocabulary):
+        """
+        Load a vocabulary into NAO's ASR, skipping the round-trip if it is already loaded
+        The ASR must be paused, as it is whenever _listen isn't waiting for an answer
+        """
+        vocabulary = tuple(vocabulary)
+        if vocabulary == self._last_vocabulary:
+            return
+
+        self.asr.setVocabulary(list(vocabulary), False)  # False means don't enable word spotting
+        self._last_vocabulary = vocabulary
+
+    def _wait_for_words(self, timeout):
+        """
+        Block until NAO recognizes a word, then briefly collect any words that follow (at most timeout + 0.5s)
+        Returns the recognized words as one string, or None if nothing was heard in time
+        """
+        words = []
+        # Stop collecting at the deadline, however many words keep arriving
+        deadline = time.time() + timeout + 0.5
+        while self.speech_listener.word_event.wait(timeout):
+            for word in self.speech_listener.take_words():
+                print("Recognized: " + word)
+                words.append(word)
+            timeout = min(0.5, deadline - time.time())  # Brief pause to collect more words
+            if timeout <= 0:
+                break
+
+        if not words:
+            return None
+        return " ".join(words)
 
     def _listen(self, timeout=8.0, vocabulary=None):
         """
@@ -85,75 +310,39 @@ class PhysiotherapyAssistant(object):
         """
 
         if vocabulary is None:
-            # Basic vocabulary for general responses
-            vocabulary = [
-                "yes", "no", "maybe","father","Bob","Walking", "Lifting", "Running", "Legs", "Knee", "Jack", "Knee and Shoulder", "Shoulder"
-                "good", "bad", "okay", "fine",
-                "pain", "hurt", "sore", "ache",
-                "left", "right", "arm", "leg", "back", "neck", "shoulder", "knee", "hip",
-                "daily", "weekly", "sometimes", "always", "never",
-                "mild", "moderate", "severe", "extreme",
-                "walk", "sit", "stand", "lift", "climb", "bend",
-                "medication", "surgery", "injury", "accident",
-                "doctor", "hospital", "therapy", "treatment",
-                "better", "worse", "same", "improving", "worsening",
-                "exercise", "stretch", "mobility", "strength",
-                "morning", "afternoon", "evening", "night",
-                "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten","forty"
-            ]
-            # Add numbers for age, pain scale, etc.
-            for i in range(1, 100):
-                vocabulary.append(str(i))
+            vocabulary = self.DEFAULT_VOCABULARY
 
         # Set vocabulary for recognition
-        self.asr.pause(True)
-        self.asr.setVocabulary(vocabulary, False)  # False means don't enable word spotting
+        self._set_vocabulary(vocabulary)
+
+        # Drop any recognition left over from an earlier question
+        self.speech_listener.take_words()
+        self.memory.insertData(self.speech_event, [])
 
         # Start recognition
-        self.asr.subscribe("PhysiotherapyAssistant")
         self.asr.pause(False)
-        # Listen for the specified timeout
-        self._speak("I'm listening...", animated=False)
+        # Listen for the specified timeout, with green eyes to show NAO is listening
+        self.leds.post.fadeRGB("FaceLeds", 0x00FF00, 0.1)
 
         # Wait for response
-        start_time = time.time()
-        response = None
-
-        while time.time() - start_time < timeout and not response:
-            # Check if we've recognized a word
-            word_recognized = self.memory.getData(self.speech_event)
-
-            # word_recognized is a list where first element is the word, second is confidence
-            if word_recognized and len(word_recognized) >= 2 and word_recognized[1] > 0.4:
-                response = word_recognized[0]
-                print("Recognized: " + response)
-                time.sleep(0.5)  # Brief pause to collect more words
-
-                # For a real application, we would use a more sophisticated approach
-                # to collect multiple words and form sentences.                
-                # partial phrases or single words in context.
-
-            time.sleep(0.2)  # Check every 200ms
+        response = self._wait_for_words(timeout)
 
         # Stop recognition
-        self.asr.unsubscribe("PhysiotherapyAssistant")
+        self.asr.pause(True)
+        self.leds.post.fadeRGB("FaceLeds", 0xFFFFFF, 0.1)
 
         if not response:
             self._speak("I didn't catch that. Let's try a simpler approach.")
             # If formal ASR failed, try a basic yes/no question as fallback
             self._speak("Can you answer with just yes or no?")
-            self.asr.pause(True)
-            self.asr.setVocabulary(["yes", "no"], False)
-            self.asr.subscribe("PhysiotherapyAssistant")
+            self._set_vocabulary(self.YES_NO_VOCABULARY)
+            self.speech_listener.take_words()
+            self.memory.insertData(self.speech_event, [])
             self.asr.pause(False)
-            start_time = time.time()
-            while time.time() - start_time < 5.0 and not response:
-                word_recognized = self.memory.getData(self.speech_event)
-                if word_recognized and len(word_recognized) >= 2 and word_recognized[1] > 0.4:
-                    response = word_recognized[0]
-                time.sleep(0.2)
-
-            self.asr.unsubscribe("PhysiotherapyAssistant")
+            self.leds.post.fadeRGB("FaceLeds", 0x00FF00, 0.1)
+            response = self._wait_for_words(5.0)
+            self.asr.pause(True)
+            self.leds.post.fadeRGB("FaceLeds", 0xFFFFFF, 0.1)
 
         # Simulated response for development and testing
         # In a real environment, we'd use NAO's ASR more effectively
@@ -163,101 +352,102 @@ class PhysiotherapyAssistant(object):
         if not response:
             print("ASR failed to get response, using simulated input")
             # This is just for demonstration purposes
-            simulated_responses = {
-                "name": "John Smith",
-                "age": "45",
-                "phone": "555-123-4567",
-                "emergency": "Mary Smith, wife, 555-987-6543",
-                "conditions": "Lower back pain for 3 months, mild hypertension",
-                "medications": "Ibuprofen occasionally, blood pressure medication daily",
-                "surgeries": "No previous surgeries",
-                "allergies": "No known allergies",
-                "pain": "Lower back, worse on the right side",
-                "pain_scale": "6 out of 10 when standing for long periods",
-                "worse": "Sitting for long periods and bending forward",
-                "activities": "Difficulty gardening and carrying groceries",
-                "previous": "No previous physiotherapy",
-                "goals": "I want to be able to garden again without pain and return to my walking routine"
-            }
-
-            # Map question context to simulated responses
-            response_key = None
-            if "name" in self.current_function_context:
-                response_key = "name"
-            elif "age" in self.current_function_context:
-                response_key = "age"
-            elif "phone" in self.current_function_context:
-                response_key = "phone"
-            elif "emergency" in self.current_function_context:
-                response_key = "emergency"
-            elif "medical condition" in self.current_function_context:
-                response_key = "conditions"
-            elif "medication" in self.current_function_context:
-                response_key = "medications"
-            elif "surgeries" in self.current_function_context:
-                response_key = "surgeries"
-            elif "allergies" in self.current_function_context:
-                response_key = "allergies"
-            elif "pain" in self.current_function_context and "scale" not in self.current_function_context:
-                response_key = "pain"
-            elif "scale" in self.current_function_context:
-                response_key = "pain_scale"
-            elif "worse" in self.current_function_context:
-                response_key = "worse"
-            elif "activities" in self.current_function_context:
-                response_key = "activities"
-            elif "previous" in self.current_function_context:
-                response_key = "previous"
-            elif "goals" in self.current_function_context:
-                response_key = "goals"
-            else:
-                response_key = "name"  # Default fallback
-
-            response = simulated_responses.get(response_key, "Yes")
+            # The question context is the simulated response key; unknown contexts fall back to the name
+            response = self.SIMULATED_RESPONSES.get(self.current_function_context,
+                                                    self.SIMULATED_RESPONSES["name"])
 
         return response
 
-    def _llm_interact(self, prompt, patient_context=None, system_role=None):
-        """Interact with local Ollama LLM to generate responses"""
-        try:
-            # Default system role for physiotherapy assistant
-            if system_role is None:
-                system_role = """
-                You are a professional physiotherapy assistant helping to gather patient information.
-                Keep your responses concise and focused on physiotherapy assessment.
-                Ask one question at a time and wait for a response.
-                Format your responses to be spoken by a NAO robot.
-                """
+    def _update_patient(self, section, key, value):
+        """
+        Store a value in the current patient's record
+        - section: e.g. "personal_info", or None for a top-level field
+        """
+        if section is None:
+            self.current_patient[key] = value
+        else:
+            self.current_patient[section][key] = value
+        self._patient_json_cache = None
+
+    def _patient_json(self):
+        """Return the current patient record as JSON, serialized once per change"""
+        if self._patient_json_cache is None:
+            self._patient_json_cache = json.dumps(self.current_patient)
+        return self._patient_json_cache
+
+    def _build_messages(self, prompt, patient_context=None, system_role=None):
+        """Build the Ollama chat messages for a prompt"""
+        # Default system role for physiotherapy assistant
+        if system_role is None:
+            system_role = """
+            You are a professional physiotherapy assistant helping to gather patient information.
+            Keep your responses concise and focused on physiotherapy assessment.
+            Ask one question at a time and wait for a response.
+            Format your responses to be spoken by a NAO robot.
+            """
 
-            # Prepare messages with context
-            messages = []
+        # Prepare messages with context
+        messages = []
 
-            # Add system role
-            if system_role:
-                messages.append({"role": "system", "content": system_role})
+        # Add system role
+        if system_role:
+            messages.append({"role": "system", "content": system_role})
 
-            # Add patient context if available
-            if patient_context:
-                messages.append({"role": "system", "content": "Patient context: " + json.dumps(patient_context)})
+        # Add patient context if available
+        if patient_context:
+            if patient_context is self.current_patient:
+                context_json = self._patient_json()
+            else:
+                context_json = json.dumps(patient_context)
+            messages.append({"role": "system", "content": "Patient context: " + context_json})
+
+        # Add the current prompt
+        messages.append({"role": "user", "content": prompt})
+
+        return messages
+
+    def _fallback_response(self, prompt):
+        """Provide a simple canned response when the LLM cannot be reached"""
+        if "pain" in prompt.lower():
+            return "I understand you're experiencing pain. Could you tell me more about where it hurts and what makes it worse?"
+        elif "medication" in prompt.lower():
+            return "Thank you for sharing about your medication. It's important for us to know this for your treatment plan."
+        elif "exercise" in prompt.lower():
+            return "Exercises are an important part of physiotherapy. We'll make sure to develop a suitable program for you."
+        else:
+            return "Thank you for sharing that information. It will help us provide better care for you."
 
-            # Add the current prompt
-            messages.append({"role": "user", "content": prompt})
+    def _llm_interact(self, prompt, patient_context=None, system_role=None, max_tokens=128, temperature=0.2,
+                      json_mode=False):
+        """
+        Interact with local Ollama LLM to generate responses
+        - max_tokens: limit on the length of the reply; every extra token adds decode time
+        - temperature: sampling temperature, kept low for consistent summaries
+        - json_mode: constrain the reply to a valid JSON object
+        """
+        # Once Ollama has refused the connection, answer locally instead of waiting on it
+        if self.ollama_available is False:
+            return self._fallback_response(prompt)
 
+        try:
             # Prepare the request payload for Ollama
             payload = {
                 "model": self.ollama_model,
-                "messages": messages,
-                "stream": False
+                "messages": self._build_messages(prompt, patient_context, system_role),
+                "stream": False,
+                "keep_alive": _OLLAMA_KEEP_ALIVE,
+                "options": {"num_predict": max_tokens, "temperature": temperature, "num_ctx": self.ollama_num_ctx}
             }
+            if json_mode:
+                payload["format"] = "json"
 
-            # Send request to Ollama
-            response = requests.post(
-                self.ollama_url + "/api/chat",
-                headers={"Content-Type": "application/json"},
-                data=json.dumps(payload)
-            )
+            # Send request to Ollama over the pooled session
+            read_timeout = _OLLAMA_READ_TIMEOUT_BASE + _OLLAMA_READ_TIMEOUT_PER_TOKEN * max_tokens
+            response = self.session.post(self.ollama_url + "/api/chat", json=payload,
+                                         timeout=(_OLLAMA_CONNECT_TIMEOUT, read_timeout))
 
             if response.status_code == 200:
+                self.ollama_available = True
                 response_data = response.json()
                 return response_data["message"]["content"]
             else:
@@ -267,39 +457,109 @@ class PhysiotherapyAssistant(object):
 
         except Exception as e:
             print("Error with Ollama LLM service: " + str(e))
-            # Provide a simple fallback response
-            if "pain" in prompt.lower():
-                return "I understand you're experiencing pain. Could you tell me more about where it hurts and what makes it worse?"
-            elif "medication" in prompt.lower():
-                return "Thank you for sharing about your medication. It's important for us to know this for your treatment plan."
-            elif "exercise" in prompt.lower():
-                return "Exercises are an important part of physiotherapy. We'll make sure to develop a suitable program for you."
-            else:
-                return "Thank you for sharing that information. It will help us provide better care for you."
+            return self._fallback_response(prompt)
+
+    def _parse_llm_json(self, text):
+        """Parse JSON from an LLM reply, ignoring any markdown code fences around it"""
+        text = text.strip()
+        if text.startswith("```"):
+            text = text.strip("`")
+            if text.startswith("json"):
+                text = text[len("json"):]
+        return json.loads(text)
+
+    def _interpret_batch(self, qa_pairs, system_role):
+        """
+        Interpret several question/answer pairs with a single LLM call
+        Returns one interpretation string per pair, or None if the reply could not be parsed
+        """
+        if not qa_pairs:
+            return []
 
-    def greet_patient(self):
-        """Greet the patient and introduce NAO as a physiotherapy assistant"""
-        # Wave gesture
-        self.motion.setAngles("RShoulderPitch", 0.5, 0.2)
-        self.motion.setAngles("RShoulderRoll", -0.3, 0.2)
-        self.motion.setAngles("RElbowRoll", 1.0, 0.2)
-        self.motion.setAngles("RElbowYaw", 1.3, 0.2)
-        self.motion.setAngles("RWristYaw", 0.0, 0.2)
-        self.motion.setAngles("RHand", 0.8, 0.2)
+        prompt = ("Return a JSON object {\"items\": [...]}; for each item output "
+                  "{\"summary\": ..., \"key_findings\": [...]}, in the same order as the items. Items: "
+                  + json.dumps(qa_pairs))
+        reply = self._llm_interact(prompt, system_role=system_role, max_tokens=80 * len(qa_pairs), json_mode=True)
 
-        time.sleep(0.5)
+        try:
+            items = self._parse_llm_json(reply)
+            if isinstance(items, dict):
+                items = items.get("items")
+            return self._format_interpretations(items, len(qa_pairs))
+        except Exception as e:
+            print("Could not parse batched interpretation, interpreting one by one: " + str(e))
+            return None
 
-        # Wave hand
-        for _ in range(2):
-            self.motion.setAngles("RElbowRoll", 0.8, 0.2)
-            time.sleep(0.4)
-            self.motion.setAngles("RElbowRoll", 1.0, 0.2)
-            time.sleep(0.4)
+    def _interpret_with_summary(self, qa_pairs, system_role):
+        """
+        Interpret assessment question/answer pairs and summarize the whole patient record in one LLM call
+        Returns (interpretations, summary), or None if the reply could not be parsed
+        """
+        prompt = """
+        Return a JSON object {"interpretations": [...], "summary": "..."}.
+        In "interpretations", for each item output {"summary": ..., "key_findings": [...]}, in the same order as the items.
+        In "summary", write a concise summary of this patient's physiotherapy assessment, based on the patient
+        context and the items, for the physiotherapist.
 
-        # Reset arm position
-        self.motion.setAngles("RShoulderPitch", 1.4, 0.2)
-        self.motion.setAngles("RShoulderRoll", -0.1, 0.2)
+        Include:
+        1. Key symptoms and affected areas
+        2. Relevant medical history
+        3. Functional limitations
+        4. Preliminary recommendations
+
+        Items: %s
+        """ % json.dumps(qa_pairs)
 
+        reply = self._llm_interact(
+            prompt,
+            patient_context=self.current_patient,
+            system_role=system_role,
+            max_tokens=80 * len(qa_pairs) + 400,
+            json_mode=True
+        )
+
+        try:
+            result = self._parse_llm_json(reply)
+            interpretations = self._format_interpretations(result.get("interpretations"), len(qa_pairs))
+            summary = result.get("summary")
+            if not summary:
+                raise ValueError("missing summary")
+            return interpretations, summary
+        except Exception as e:
+            print("Could not parse combined interpretation and summary, falling back to separate calls: " + str(e))
+            return None
+
+    def _format_interpretations(self, items, count):
+        """Turn parsed {summary, key_findings} items into interpretation strings, checking there is one per answer"""
+        if not isinstance(items, list) or len(items) != count:
+            raise ValueError("expected " + str(count) + " interpretations")
+
+        interpretations = []
+        for item in items:
+            interpretation = item.get("summary", "")
+            findings = item.get("key_findings")
+            if isinstance(findings, list) and findings:
+                interpretation += " Key findings: " + ", ".join(findings)
+            interpretations.append(interpretation)
+        return interpretations
+
+    def close(self):
+        """Release the ASR and speech event subscriptions and the HTTP connection pool"""
+        if self._closed:
+            return
+        self._closed = True
+
+        self.asr.unsubscribe("PhysiotherapyAssistant")
+        self.memory.unsubscribeToEvent(self.speech_event, "PhysioSpeechListener")
+        self.broker.shutdown()
+        self.session.close()
+
+    def _wave_hand(self):
+        """Wave the raised right hand by swinging the elbow, in a single motion call"""
+        self.motion.angleInterpolation(["RElbowRoll"], [[0.8, 1.0, 0.8, 1.0]], [[0.4, 0.8, 1.2, 1.6]], True)
+
+    def greet_patient(self):
+        """Greet the patient and introduce NAO as a physiotherapy assistant"""
         # Greeting speech
         greeting = """
         Hello! I'm NAO, your physiotherapy assistant today. 
@@ -309,7 +569,22 @@ class PhysiotherapyAssistant(object):
         For best results, please speak clearly and directly toward me.
         """
 
-        self._speak(greeting)
+        # Speak while waving; body language is off so it doesn't fight the wave
+        speech_task = self.animated_speech.post.say(greeting, {"bodyLanguageMode": "disabled"})
+
+        # Wave gesture
+        self.motion.setAngles(["RShoulderPitch", "RShoulderRoll", "RElbowRoll", "RElbowYaw", "RWristYaw", "RHand"],
+                              [0.5, -0.3, 1.0, 1.3, 0.0, 0.8], 0.2)
+
+        time.sleep(0.5)
+
+        # Wave hand
+        self._wave_hand()
+
+        # Reset arm position
+        self.motion.setAngles(["RShoulderPitch", "RShoulderRoll"], [1.4, -0.1], 0.2)
+
+        self.animated_speech.wait(speech_task, 0)
 
     def collect_personal_info(self):
         """Collect basic personal information from the patient"""
@@ -322,7 +597,7 @@ class PhysiotherapyAssistant(object):
         self._speak("What is your full name?")
         name = self._listen(15.0)
         if name:
-            self.current_patient["personal_info"]["name"] = name
+            self._update_patient("personal_info", "name", name)
 
         # Age
         self.current_function_context = "age"
@@ -333,25 +608,25 @@ class PhysiotherapyAssistant(object):
         self._speak("Thank you, " + first_name + ". What is your age?")
         age = self._listen(10.0)
         if age:
-            self.current_patient["personal_info"]["age"] = age
+            self._update_patient("personal_info", "age", age)
 
         # Contact information
         self.current_function_context = "phone"
         self._speak("What is the best phone number to reach you?")
         phone = self._listen(15.0)
         if phone:
-            self.current_patient["personal_info"]["phone"] = phone
+            self._update_patient("personal_info", "phone", phone)
 
         # Emergency contact
         self.current_function_context = "emergency"
         self._speak("In case of emergency, who should we contact and what is their relationship to you?")
         emergency_contact = self._listen(15.0)
         if emergency_contact:
-            self.current_patient["personal_info"]["emergency_contact"] = emergency_contact
+            self._update_patient("personal_info", "emergency_contact", emergency_contact)
 
         # Add timestamp - strftime in Python 2.7
-        self.current_patient["personal_info"]["registration_date"] = datetime.datetime.now().strftime(
-            "%Y-%m-%d %H:%M:%S")
+        self._update_patient("personal_info", "registration_date", datetime.datetime.now().strftime(
+            "%Y-%m-%d %H:%M:%S"))
 
         # Confirmation
         if name and ' ' in name:
@@ -372,97 +647,141 @@ class PhysiotherapyAssistant(object):
         ]
 
         # Context identifiers for simulated responses
-        contexts = ["medical condition", "medication", "surgeries", "allergies"]
+        contexts = ["conditions", "medications", "surgeries", "allergies"]
 
+        qa_pairs = []
         for i, question in enumerate(questions):
             self.current_function_context = contexts[i]
             self._speak(question)
             response = self._listen(15.0)
             if response:
-                # Use LLM to interpret and categorize the response
+                qa_pairs.append({"q": question, "a": response})
+
+        # Use LLM to interpret and categorize all responses in one call;
+        # short answers such as "yes" or "no" are kept as they are
+        system_role = "Summarize the patient's response concisely and extract key medical information."
+        to_interpret = [pair for pair in qa_pairs if not _is_trivial_response(pair["a"])]
+        interpretations = self._interpret_batch(to_interpret, system_role)
+        if interpretations is not None:
+            interpretations = iter(interpretations)
+
+        for pair in qa_pairs:
+            if _is_trivial_response(pair["a"]):
+                interpretation = pair["a"]
+            elif interpretations is not None:
+                interpretation = next(interpretations)
+            else:
                 interpretation = self._llm_interact(
-                    "Interpret this patient response to '" + question + "': " + response,
-                    system_role="Summarize the patient's response concisely and extract key medical information."
+                    "Interpret this patient response to '" + pair["q"] + "': " + pair["a"],
+                    system_role=system_role,
+                    max_tokens=80
                 )
 
-                # Store both raw response and interpretation
-                # Python 2.7 compatible string handling for dict key creation
-                key = question.lower().replace("?", "").replace(" ", "_")[:30]
-                self.current_patient["medical_history"][key] = {
-                    "question": question,
-                    "response": response,
-                    "interpretation": interpretation
-                }
+            # Store both raw response and interpretation
+            # Python 2.7 compatible string handling for dict key creation
+            key = _KEY_RE.sub("_", pair["q"].lower()).strip("_")[:30]
+            self._update_patient("medical_history", key, {
+                "question": pair["q"],
+                "response": pair["a"],
+                "interpretation": interpretation
+            })
 
         # Confirmation
         self._speak(
             "Thank you for sharing your medical history. This information will help us provide appropriate care.")
 
-    def physiotherapy_assessment(self):
-        """Conduct a physiotherapy-specific assessment"""
-        self._speak("Now, let's talk specifically about what brings you in for physiotherapy today.")
-
-        # Dynamically generate questions using LLM
-        #assessment_prompt = """
-        #Based on the patient's information so far: %s,
-        #generate 5 specific physiotherapy assessment questions that would be most relevant.
-        #Focus on pain location, movement limitations, daily activities affected, and treatment history.
-        #Format as a JSON list of questions only.
-        #""" % json.dumps(self.current_patient)
-
+    def _generate_assessment_questions(self):
+        """Dynamically generate assessment questions using LLM, falling back to the standard questions"""
         assessment_prompt = """
-        generate 5 specific physiotherapy assessment questions
-        """
-
-
+        Based on the patient's information so far: %s,
+        generate 5 specific physiotherapy assessment questions that would be most relevant.
+        Focus on pain location, movement limitations, daily activities affected, and treatment history.
+        Format as a JSON object with a "questions" list of questions only.
+        """ % self._patient_json()
 
         questions_json = self._llm_interact(
             assessment_prompt,
-            system_role="You are a physiotherapy assistant generating assessment questions."
+            system_role="You are a physiotherapy assistant generating assessment questions.",
+            max_tokens=256,
+            json_mode=True
         )
 
         try:
-            # Try to parse the response as JSON
-            questions = json.loads(questions_json)
-        except:
-            # Fallback questions if JSON parsing fails
-            questions = [
-                "Can you describe where you're experiencing pain or discomfort?",
-                "On a scale of 0-10, how would you rate your pain, with 10 being the most severe?",
-                "What movements or activities make your symptoms worse?",
-                "What daily activities are difficult for you because of this issue?",
-                "Have you had physiotherapy for this condition before? If so, what worked or didn't work?"
-            ]
+            questions = self._parse_llm_json(questions_json)["questions"]
+            if isinstance(questions, list) and questions:
+                return questions
+        except Exception as e:
+            print("Could not parse generated assessment questions: " + str(e))
+        return self.ASSESSMENT_QUESTIONS
+
+    def physiotherapy_assessment(self):
+        """Conduct a physiotherapy-specific assessment"""
+        self._speak("Now, let's talk specifically about what brings you in for physiotherapy today.")
+
+        questions = self.ASSESSMENT_QUESTIONS
+        if self.dynamic_questions:
+            questions = self._generate_assessment_questions()
 
         # Context identifiers for simulated responses
-        contexts = ["pain", "pain scale", "worse", "activities", "previous"]
+        contexts = ["pain", "pain_scale", "worse", "activities", "previous"]
 
+        qa_pairs = []
         for i, question in enumerate(questions):
             self.current_function_context = contexts[
                 i % len(contexts)]  # Use modulo in case we have more than 5 questions
             self._speak(question)
             response = self._listen(5.0)
             if response:
-                # Generate a summary of the response
-                summary = self._llm_interact(
-                    "Summarize this physiotherapy assessment response concisely: " + response,
-                    system_role="Extract key physiotherapy assessment information."
-                )
-                #self._speak(summary)
-                # Store the information
-                key = question.lower().replace("?", "").replace(" ", "_")[:30]
-                self.current_patient["physiotherapy_assessment"][key] = {
-                    "question": question,
-                    "response": response,
-                    "summary": summary
-                }
+                qa_pairs.append({"q": question, "a": response})
 
         # Final question about goals
         self.current_function_context = "goals"
         self._speak("What are your goals for physiotherapy? What would you like to be able to do when you recover?")
         goals = self._listen(15.0)
         if goals:
-            self.current_patient["physiotherapy_assessment"]["goals"] = goals
+            self._update_patient("physiotherapy_assessment", "goals", goals)
+
+        # Short answers such as "yes" or "no" need no summary; store them first
+        # so the overall summary below still sees them in the patient record
+        to_interpret = []
+        for pair in qa_pairs:
+            if _is_trivial_response(pair["a"]):
+                self._store_assessment_answer(pair, pair["a"])
+            else:
+                to_interpret.append(pair)
+
+        # Summarize all other responses and the overall assessment in one call
+        result = self._interpret_with_summary(
+            to_interpret,
+            "Extract key physiotherapy assessment information and create a patient summary for the physiotherapist."
+        )
+        summaries = result[0] if result else None
+
+        for i, pair in enumerate(to_interpret):
+            if summaries is not None:
+                summary = summaries[i]
+            else:
+                summary = self._llm_interact(
+                    "Summarize this physiotherapy assessment response concisely: " + pair["a"],
+                    system_role="Extract key physiotherapy assessment information.",
+                    max_tokens=80
+                )
+            #self._speak(summary)
+            self._store_assessment_answer(pair, summary)
+
+        if result:
+            self._update_patient(None, "assessment_summary", result[1])
+        else:
+            self._update_patient(None, "assessment_summary", self._request_summary())
+
+    def _store_assessment_answer(self, pair, summary):
+        """Store an assessment question, the patient's response and its summary"""
+        key = _KEY_RE.sub("_", pair["q"].lower()).strip("_")[:30]
+        self._update_patient("physiotherapy_assessment", key, {
+            "question": pair["q"],
+            "response": pair["a"],
+            "summary": summary
+        })
 
     def save_patient_profile(self):
         """Save the patient profile to a JSON file"""
@@ -470,23 +789,34 @@ class PhysiotherapyAssistant(object):
             self._speak("I don't have enough information to save a profile. Let's try again.")
             return False
 
-        # Create a filename based on patient name and date
-        name = self.current_patient["personal_info"]["name"]
-        safe_name = name.lower().replace(" ", "_")
-        date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = os.path.join(self.patients_dir, safe_name + "_" + date + ".json")
+        # Create a filename based on patient name and date, once per patient
+        if self._profile_path is None:
+            name = self.current_patient["personal_info"]["name"]
+            safe_name = name.lower().replace(" ", "_")
+            date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            self._profile_path = os.path.join(self.patients_dir, safe_name + "_" + date + ".json")
 
         # Save the profile - Python 2.7 file handling
+        # Write to a temporary file first so a partial write never replaces the profile
         try:
-            with open(filename, 'w') as f:
-                json.dump(self.current_patient, f, indent=4)
+            tmp_filename = self._profile_path + ".tmp"
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.current_patient, f, separators=(",", ":"))
+            # os.rename can't replace an existing file on Windows (Python 2 has no os.replace)
+            if os.name == "nt" and os.path.exists(self._profile_path):
+                os.remove(self._profile_path)
+            os.rename(tmp_filename, self._profile_path)
             return True
         except Exception as e:
             print("Error saving patient profile: " + str(e))
             return False
 
     def generate_summary(self):
-        """Generate a summary of the patient assessment"""
+        """Return the summary of the patient assessment, produced during physiotherapy_assessment"""
+        return self.current_patient.get("assessment_summary", "")
+
+    def _request_summary(self):
+        """Ask the LLM for a summary of the patient assessment on its own"""
         summary_prompt = """
         Create a concise summary of this patient's physiotherapy assessment based on:
         %s
@@ -496,58 +826,58 @@ class PhysiotherapyAssistant(object):
         2. Relevant medical history
         3. Functional limitations
         4. Preliminary recommendations
-        """ % json.dumps(self.current_patient)
+        """ % self._patient_json()
 
         summary = self._llm_interact(
             summary_prompt,
-            system_role="You are a physiotherapy assistant creating a patient summary for the physiotherapist."
+            system_role="You are a physiotherapy assistant creating a patient summary for the physiotherapist.",
+            max_tokens=400
         )
 
         return summary
 
     def conclude_assessment(self):
         """Conclude the assessment and inform the patient of next steps"""
-        # Save the profile
+        # Inform the patient
+        conclusion = """
+        Thank you for providing all this information. I've recorded your details for the physiotherapist.
+        The physiotherapist will review this information before your session.
+        They'll develop a personalized treatment plan based on your needs and goals.
+        Is there anything else you'd like to share before we finish?
+        """
+
+        # Start the conclusion first and save the profile while NAO is speaking;
+        # without a name there is nothing to save, and save_patient_profile explains that itself
+        conclusion_task = None
+        if self.current_patient["personal_info"].get("name"):
+            conclusion_task = self._speak(conclusion, wait=False)
+
+        # Save the profile, which already includes the assessment summary
         saved = self.save_patient_profile()
 
-        if saved:
-            # Generate a summary
-            summary = self.generate_summary()
-            self.current_patient["assessment_summary"] = summary
-
-            # Update the saved file with the summary
-            self.save_patient_profile()
-
-            # Inform the patient
-            conclusion = """
-            Thank you for providing all this information. I've recorded your details for the physiotherapist.
-            The physiotherapist will review this information before your session.
-            They'll develop a personalized treatment plan based on your needs and goals.
-            Is there anything else you'd like to share before we finish?
-            """
+        if conclusion_task is not None:
+            self.animated_speech.wait(conclusion_task, 0)
 
-            self._speak(conclusion)
+        if saved:
             #self.current_function_context = "final comments"
             #final_comments = self._listen(15.0)
             #if final_comments:
             #    self.current_patient["final_comments"] = final_comments
             #    self.save_patient_profile()
 
-            # Final goodbye
-            self._speak("The physiotherapist will be with you shortly. I hope you have a productive session today ThankYou!")
+            # Final goodbye, spoken while waving
+            speech_task = self.animated_speech.post.say(
+                "The physiotherapist will be with you shortly. I hope you have a productive session today ThankYou!",
+                {"bodyLanguageMode": "disabled"})
 
             # Wave goodbye
-            self.motion.setAngles("RShoulderPitch", 0.5, 0.2)
-            self.motion.setAngles("RShoulderRoll", -0.3, 0.2)
-            self.motion.setAngles("RWristYaw", 0.0, 0.2)
-            self.motion.setAngles("RHand", 0.8, 0.2)
+            self.motion.setAngles(["RShoulderPitch", "RShoulderRoll", "RWristYaw", "RHand"],
+                                  [0.5, -0.3, 0.0, 0.8], 0.2)
 
             # Wave hand
-            for _ in range(2):
-                self.motion.setAngles("RElbowRoll", 0.8, 0.2)
-                time.sleep(0.4)
-                self.motion.setAngles("RElbowRoll", 1.0, 0.2)
-                time.sleep(0.4)
+            self._wave_hand()
+
+            self.animated_speech.wait(speech_task, 0)
 
             # Reset to a neutral posture
             self.posture.goToPosture("Stand", 0.8)
@@ -559,17 +889,13 @@ class PhysiotherapyAssistant(object):
         try:
             # Start the assessment
             self.greet_patient()
-            time.sleep(1)
 
             # Collect information
             self.collect_personal_info()
-            time.sleep(1)
 
             self.conduct_medical_history()
-            time.sleep(1)
 
             self.physiotherapy_assessment()
-            time.sleep(1)
 
             # Conclude
             self.conclude_assessment()
@@ -591,5 +917,8 @@ if __name__ == "__main__":
     # Create the assistant
     assistant = PhysiotherapyAssistant(ROBOT_IP, ollama_url=OLLAMA_URL)
     # Run the assessment
-    assistant.run_full_assessment()
+    try:
+        assistant.run_full_assessment()
+    finally:
+        assistant.close()
 